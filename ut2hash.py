@@ -2,21 +2,45 @@
 
 import argparse
 import hashlib
+import mmap
 import os
 import os.path
 import sqlite3
 import struct
 import traceback
-import zlib
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from sys import modules, stdout, stderr, exc_info
 
+# python-isal inflates noticeably faster than stdlib zlib, use it if present
+try: from isal import isal_zlib as zlib
+except ImportError: import zlib
+
 # check if MD5 is available -- sometimes it isn't
 if "md5" not in hashlib.algorithms_available:
     raise NotImplementedError("MD5 isn't available on this Python build!")
 
+# MD5 constructor used for hashing files. hashlib's MD5 comes from OpenSSL,
+# which already has an assembly block function; swap this out if you have a
+# faster backend with the same update()/digest() interface.
+new_md5 = hashlib.md5
+
 VERSION = 0x0100
 PERIODICALLY_COMMIT = 100 # adjust to not destroy your drive
+BATCH_SIZE = 1000 # rows per executemany() transaction when scanning
+
+# file extensions we know how to hash, casefolded and without the dot
+_UZ2_EXT = "uz2" # compressed; hashed after decompression
+_EXTS = frozenset(("u", "ucl", #"est", "frt", "int", "itt", "kot", "det",
+                   "ukx", "uxx", "ka", "ut2", "ogg", "uax", "usx", "utx"))
+
+# characters allowed in a (casefolded) MD5 search string
+_HEX_SET = frozenset("0123456789abcdef")
+
+# UZ2 chunk header: compressed size, uncompressed size
+_uz2_unpack = struct.Struct("<II").unpack_from
 
 # useful console logging!
 
@@ -47,13 +71,69 @@ def log(*args, level=3, sep=' '):
     print(prefix, *args, sep=sep, file=file)
 
 
+def advise_sequential(f, m=None):
+    """Hint the OS that open file f (and its mapping m, if it has one) will be
+    read front to back"""
+    # these are only hints, and neither exists on Windows
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if m is not None and hasattr(mmap, "MADV_SEQUENTIAL"):
+            m.madvise(mmap.MADV_SEQUENTIAL)
+    except OSError: pass
+
+
+def uz2_index(fn, buf):
+    """Walk the chunk headers of a UZ2 file held in buf, and return a list of
+    (offset, compressed size, uncompressed size) for each chunk, or None if
+    the file is truncated"""
+    # each chunk is an 8 byte header followed by a zlib stream
+    index = []
+    off = 0
+    end = len(buf)
+    while off < end:
+        try: cs, us = _uz2_unpack(buf, off)
+        except struct.error: # we're at EOF expectedly
+            log("Expected EOF in `{:s}` at chunk index {:d}"\
+                .format(fn, len(index)), level=4)
+            break
+        # Input validation
+        if cs > 33096:
+            log("{:s} chunk {:d} reports oversize compressed size"\
+                .format(fn, len(index)), level=2)
+        elif us > 32768:
+            log("{:s} chunk {:d} reports oversize uncompressed size"\
+                .format(fn, len(index)), level=2)
+        elif cs == 0:
+            log("{:s} chunk {:d} reports zero compressed size"\
+                .format(fn, len(index)), level=1)
+            # the code will probably crash, might need to handle
+        elif us == 0:
+            log("{:s} chunk {:d} reports zero uncompressed size"\
+                .format(fn, len(index)), level=1)
+            # the code will probably crash, might need to handle
+        off += 8
+        if off+cs > end: # we're at EOF unexpectedly
+            log("Unexpected EOF in `{:s}` chunk index {:d}"\
+                .format(fn, len(index)), level=1)
+            return None
+        index.append((off, cs, us))
+        off += cs
+    return index
+
+
 class Database(object):
     """Create sqlite3 db to store md5 hashes"""
     def __init__(self, fn="hashes.sqb"):
         log("Opening access to table", level=4)
         self.fn = fn
-        self.conn = sqlite3.connect(fn)
+        # autocommit at the driver level; transactions are opened explicitly
+        self.conn = sqlite3.connect(fn, isolation_level=None)
         self.c = self.conn.cursor()
+        # WAL + relaxed syncing keeps the periodic commits cheap
+        self.c.executescript("PRAGMA journal_mode=WAL; \
+PRAGMA synchronous=NORMAL; PRAGMA temp_store=MEMORY; \
+PRAGMA cache_size=-65536; PRAGMA mmap_size=268435456;")
         self.count = 0
         self.force_casefold = False
 
@@ -77,22 +157,73 @@ class Database(object):
             log("Deleting table contents by request", level=2)
             self.c.execute("DROP TABLE IF EXISTS hashes")
         log("Table initialized by request", level=4)
-        self.c.execute("CREATE TABLE IF NOT EXISTS hashes(id INTEGER PRIMARY KEY, filename TEXT, size INTEGER, md5 TEXT);")
+        self.c.execute("CREATE TABLE IF NOT EXISTS hashes(id INTEGER PRIMARY KEY, filename TEXT, size INTEGER, md5 BLOB);")
+        # md5s used to be stored as hex text, which won't match anything now
+        self.c.execute("SELECT type FROM pragma_table_info('hashes') WHERE name='md5';")
+        if self.c.fetchone()[0] != "BLOB": self.upgrade_md5_blob()
+        # md5 serves find() and GROUP BY md5; (filename, md5) serves
+        # find_by_name() and the duplicate row queries
+        self.c.execute("CREATE INDEX IF NOT EXISTS idx_md5 ON hashes(md5);")
+        self.c.execute("CREATE INDEX IF NOT EXISTS idx_fn_md5 ON hashes(filename, md5);")
         self.c.execute("SELECT MAX(id) FROM hashes;")
         self.count = self.c.fetchone()[0]
         if self.count is None: self.count = 0
         self.count += 1 # go to next available index
 
+    def upgrade_md5_blob(self):
+        """Convert a table from an older version, which stored hex md5s as
+        text, to raw md5 blobs; all or nothing"""
+        log("Converting table from an older version to binary MD5s", level=2)
+        if self.conn.in_transaction: self.conn.commit()
+        self.conn.execute("BEGIN")
+        try:
+            # renaming takes any old indexes along, and dropping the old
+            # table later takes them away again
+            self.c.execute("ALTER TABLE hashes RENAME TO hashes_old;")
+            self.c.execute("CREATE TABLE hashes(id INTEGER PRIMARY KEY, filename TEXT, size INTEGER, md5 BLOB);")
+            old = self.conn.execute("SELECT id, filename, size, md5 FROM hashes_old;")
+            self.c.executemany("INSERT INTO hashes VALUES (?, ?, ?, ?);",
+                               ((i, fn, size, bytes.fromhex(md5))
+                                for i, fn, size, md5 in old))
+            self.c.execute("DROP TABLE hashes_old;")
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            log("Couldn't convert the table -- wipe and build it again",
+                level=0)
+            raise
+        log("Converted {:d} rows".format(self.count_rows()), level=3)
+
     def put(self, fn, size, md5):
-        """Put formatted data in the database"""
-        assert len(md5) == 32, "Invalid MD5 length!"
+        """Put formatted data in the database; md5 may be hex or raw bytes"""
+        if isinstance(md5, str): md5 = bytes.fromhex(md5)
+        assert len(md5) == 16, "Invalid MD5 length!"
         if self.force_casefold: fn = fn.casefold()
+        if not self.conn.in_transaction: self.conn.execute("BEGIN")
         self.c.execute("INSERT INTO hashes VALUES (?, ?, ?, ?);", \
                        (self.count, fn, size, md5))
         self.count += 1
         # periodically commit because i am paranoid
         if self.count % PERIODICALLY_COMMIT == 0: self.conn.commit()
 
+    def put_many(self, rows):
+        """Put many (fn, size, md5) rows in the database in one transaction;
+        md5 is the raw 16 byte digest"""
+        rows = list(rows)
+        if not rows: return
+        for fn, size, md5 in rows:
+            assert len(md5) == 16, "Invalid MD5 length!"
+        if self.force_casefold:
+            rows = [(fn.casefold(), size, md5) for fn, size, md5 in rows]
+        # flush anything left over from put() so BEGIN doesn't nest
+        if self.conn.in_transaction: self.conn.commit()
+        self.conn.execute("BEGIN")
+        self.c.executemany("INSERT INTO hashes VALUES (?, ?, ?, ?);",
+                           ((self.count + i, fn, size, md5)
+                            for i, (fn, size, md5) in enumerate(rows)))
+        self.conn.commit()
+        self.count += len(rows)
+
     def commit(self):
         """Convenience accessor"""
         self.conn.commit()
@@ -107,22 +238,23 @@ class Database(object):
             log("Failed to close database!", level=1)
         
     def find(self, md5):
-        """Locate data in the database, and return all matches"""
-        self.c.execute("SELECT filename, size, md5 FROM hashes WHERE md5=? ORDER BY filename COLLATE NOCASE;", (md5,))
+        """Locate data in the database, and return all matches; md5 may be
+        hex or raw bytes"""
+        if isinstance(md5, str): md5 = bytes.fromhex(md5)
+        self.c.execute("SELECT filename, size, lower(hex(md5)) FROM hashes WHERE md5=? ORDER BY filename COLLATE NOCASE;", (md5,))
         return self.c.fetchall() # possible performance considerations
 
     def find_by_name(self, filename):
         """Locate data in the database, and return all matches"""
-        self.c.execute("SELECT filename, size, md5 FROM hashes WHERE filename=? ORDER BY filename COLLATE NOCASE;", (filename,))
+        self.c.execute("SELECT filename, size, lower(hex(md5)) FROM hashes WHERE filename=? ORDER BY filename COLLATE NOCASE;", (filename,))
         return self.c.fetchall() # ^
 
     def dump(self, raw=False):
         """Print (log) the whole table contents"""
-        self.c.execute("SELECT filename, size, md5 FROM hashes ORDER BY filename;")
-        if raw: return self.c.fetchall() # PERFORMANCE! should probably generate
-        while True:
-            row = self.c.fetchone()
-            if not row: break # out of data
+        # own cursor, so rows stream out lazily without tying up self.c
+        cur = self.conn.execute("SELECT filename, size, lower(hex(md5)) FROM hashes ORDER BY filename;")
+        if raw: return cur # iterate it for rows
+        for row in cur:
             log("fn={:s} size={:d} md5={:s}".format(*row), level=3)
 
     def count_rows(self):
@@ -134,7 +266,7 @@ class Database(object):
 
     def find_duplicates(self):
         """List all duplicate rows in the database; case sensitive"""
-        self.c.execute("SELECT filename, md5, COUNT(*) FROM hashes GROUP BY filename, md5 HAVING COUNT(*) > 1;")
+        self.c.execute("SELECT filename, lower(hex(md5)), COUNT(*) FROM hashes GROUP BY filename, md5 HAVING COUNT(*) > 1;")
         while True:
             row = self.c.fetchone()
             if not row: break # out of data
@@ -142,7 +274,7 @@ class Database(object):
 
     def find_duplicate_hashes(self, raw=False):
         """List all duplicate files in the database"""
-        self.c.execute("SELECT filename, md5, COUNT(md5) FROM hashes GROUP BY md5 HAVING COUNT(md5) > 1;")
+        self.c.execute("SELECT filename, lower(hex(md5)), COUNT(md5) FROM hashes GROUP BY md5 HAVING COUNT(md5) > 1;")
         while True:
             row = self.c.fetchone()
             if not row: break # out of data
@@ -169,96 +301,148 @@ class HashGrabber(object):
         """Delete the database contents, probably"""
         self.db.initialize(delete=delete)
 
-    def check_one_file(self, fn, skip_weird=True):
-        """Compute the hash of a single file"""
-        h = hashlib.md5()
+    def check_one_file(self, fn, skip_weird=True, known_size=None):
+        """Compute the hash of a single file, as (name, size, raw md5 digest);
+        pass known_size if the caller already has the file's size"""
+        ext = os.path.splitext(fn)[1][1:] # drop the dot
+        hasher = self._hashers.get(ext.casefold())
+        if hasher is None:
+            log("Filetype ({:s}) of file {} is weird!".format(ext, fn), level=4)
+            if skip_weird: return (os.path.basename(fn), None, None)
+            hasher = HashGrabber._hash_raw
+        return hasher(self, fn, known_size)
+
+    def _hash_uz2(self, fn, known_size=None):
+        """Hash the decompressed contents of a UZ2 file"""
+        h = new_md5()
+        # filename w/o path or .uz2, for db
+        rfn = os.path.basename(os.path.splitext(fn)[0])
+        log("{:s} appears to be a compressed file".format(fn), level=4)
+        with open(fn, 'rb') as f:
+            fs = known_size # known compressed filesize
+            if fs is None: fs = os.fstat(f.fileno()).st_size
+            if fs == 0: return (rfn, 0, h.digest()) # can't mmap this
+            try: m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except OSError: # some filesystems can't map; read it all in
+                advise_sequential(f)
+                buf = bytearray(fs) # one allocation, filled in place
+                n = f.readinto(buf)
+                return self._hash_uz2_chunks(fn, rfn, h, memoryview(buf)[:n])
+            with m:
+                advise_sequential(f, m)
+                mv = memoryview(m) # slices of this don't copy
+                try: return self._hash_uz2_chunks(fn, rfn, h, mv)
+                finally: mv.release() # or the mmap refuses to close
+
+    def _hash_uz2_chunks(self, fn, rfn, h, mv):
+        """Decompress every chunk of UZ2 file fn, held in mv, into hash h"""
+        size = 0 # measured decompressed filesize
+        index = uz2_index(fn, mv)
+        if index is None: return (rfn, None, None)
+        # every chunk is its own zlib stream, so a decompressobj can't carry
+        # over between them; one-shot is cheapest. input is a view of the
+        # file and the output is sized from the header, so each chunk costs
+        # one allocation, which is freed as soon as it has been hashed
+        decompress = zlib.decompress
+        for off, cs, us in index:
+            h.update(decompress(mv[off:off+cs], 15, us))
+            size += us
+        return (rfn, size, h.digest())
+
+    def _hash_cache(self, fn, known_size=None):
+        """Hash a cache file as-is, complaining about it first"""
+        log("{:s} is a cache file!".format(fn), level=2)
+        return self._hash_raw(fn, known_size)
+
+    def _hash_raw(self, fn, known_size=None):
+        """Hash an uncompressed file as-is"""
+        h = new_md5()
         rfn = os.path.basename(fn) # filename w/o path, for db
-        # compressed data -- needs decompression
-        if fn.casefold().endswith(os.path.extsep+"uz2"):
-            rfn = os.path.basename(fn[:-4]) # fn.rpartition(os.path.extsep)[0]
-            log("{:s} appears to be a compressed file".format(fn), level=4)
-            # decompress file, feed directly into md5 computation
-            chunks = 0 # debugging tool!
-            fs = os.path.getsize(fn) # known compressed filesize
-            size = 0 # measured decompressed filesize
-            with open(fn, 'rb') as f:
-                while fs > 0: # we could also while True:
-                    try: cs, us = struct.unpack("<II", f.read(8))
-                    except struct.error: # we're at EOF expectedly
-                        log("Expected EOF in `{:s}` at chunk index {:d}"\
-                            .format(fn, chunks), level=4)
-                        break
-                    # Input validation
-                    if cs > 33096:
-                        log("{:s} chunk {:d} reports oversize compressed size"\
-                            .format(fn, cs), level=2)
-                    elif us > 32768:
-                        log("{:s} chunk {:d} reports oversize uncompressed \
-size".format(fn, us), level=2)
-                    elif cs == 0:
-                        log("{:s} chunk {:d} reports zero compressed size"\
-                            .format(fn, cs), level=1)
-                        # the code will probably crash, might need to handle
-                    elif us == 0:
-                        log("{:s} chunk {:d} reports zero uncompressed size"\
-                            .format(fn, us), level=1)
-                        # the code will probably crash, might need to handle
-                    chunk = f.read(cs)
-                    fs -= 8+cs # if this is negative, something is wrong
-                    if len(chunk) != cs: # we're at EOF unexpectedly
-                        log("Unexpected EOF in `{:s}` chunk index {:d}"\
-                            .format(fn, chunks), level=1)
-                        return (rfn, None, None) # break
-                    # following debug output is noisy -- mute it
-##                    log("Decompress chunk index {:d}: cs={:d} us={:d}"\
-##                        .format(chunks, cs, us), level=4)
-                    chunk = zlib.decompress(chunk, 15, us)
-                    size += us #len(chunk)
-                    h.update(chunk)
-                    chunks += 1
-            # exit point for compressed data
-            return (rfn, size, h.hexdigest())
-        # uncompressed data of known type
-        elif any(map(lambda q:fn.casefold().endswith(q),
-                     ("u", "ucl", #"est", "frt", "int", "itt", "kot", "det",
-                      "ukx", "uxx", "ka", "ut2", "ogg", "uax", "usx", "utx"))):
-            if fn.casefold().endswith("uxx"):
-                log("{:s} is a cache file!", level=2)
-        else:
-            log("Filetype ({:s}) of file {} is weird!"\
-                .format(fn.rpartition(os.path.extsep)[2], fn), level=4)
-            if skip_weird: return (rfn, None, None)
-        size = os.path.getsize(fn)
-        if size > 2147483647:
-            log("{:s} is a huge (>2GB) file!", level=1)
-            return (rfn, None, None)
-        # read the file out in little chunks
         with open(fn, 'rb') as f:
+            size = known_size
+            if size is None: size = os.fstat(f.fileno()).st_size
+            if size > 2147483647:
+                log("{:s} is a huge (>2GB) file!".format(fn), level=1)
+                return (rfn, None, None)
+            if size == 0: return (rfn, size, h.digest()) # can't mmap this
+            try: m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except OSError: # some filesystems can't map; read in big chunks
+                advise_sequential(f)
+                buf = bytearray(1 << 20) # reused, so no allocation per read
+                bv = memoryview(buf)
+                while True:
+                    n = f.readinto(buf)
+                    if not n: break
+                    h.update(bv[:n])
+                return (rfn, size, h.digest())
+            # hash straight out of the page cache, no copies
+            with m:
+                advise_sequential(f, m)
+                h.update(m)
+        return (rfn, size, h.digest())
+
+    # casefolded extension -> hashing method, picked once per file
+    _hashers = dict.fromkeys(_EXTS, _hash_raw)
+    _hashers.update({_UZ2_EXT: _hash_uz2, "uxx": _hash_cache})
+
+    def hash_files(self, files):
+        """Compute hashes for many (path, size) pairs, yielding (path, result)
+        pairs; size may be None if it isn't known yet"""
+        # md5 and inflate both release the GIL on big buffers, so files can
+        # be hashed side by side; results still come back in path order
+        workers = os.cpu_count() or 1
+        pool = ThreadPoolExecutor(max_workers=workers)
+        files = iter(files)
+        jobs = deque()
+        try:
             while True:
-                chunk = f.read(32768)
-                if not chunk: break
-                h.update(chunk)
-        return (rfn, size, h.hexdigest())
-            
+                # only keep a few jobs queued, so an interrupt doesn't have
+                # to wait out (or throw away) the rest of the folder
+                for p, size in islice(files, 2*workers - len(jobs)):
+                    jobs.append((p, pool.submit(self.check_one_file, p,
+                                                known_size=size)))
+                if not jobs: break
+                p, job = jobs.popleft()
+                if job.exception() is not None:
+                    # This is not a very intelligent error handler
+                    log("Got some kind of error parsing {:s}".format(p),
+                        level=1)
+                    yield p, None
+                else: yield p, job.result()
+        finally:
+            # after a normal finish nothing is left; after Ctrl-C, drop the
+            # queued jobs and don't wait -- only files already open finish
+            for _, job in jobs: job.cancel()
+            pool.shutdown(wait=False)
+
     def scan_directory(self, fp):
         """Load hashes *into database* for all files in a folder"""
-        # scandir is new in 3.5, i don't have that
-        for fn in os.listdir(fp): # fn contains path relative to fp
-            p = os.path.join(fp, fn) # get reasonably full path
-            if not os.path.isfile(p):
-                log("Skipping {}: is a folder".format(fp), level=4)
-                continue
-            try: rfn, size, md5 = self.check_one_file(p)
-            except:
-                # This is not a very intelligent error handler
-                log("Got some kind of error parsing {:s}".format(rfn), level=1)
-                md5 = None # force next step to fail
-            if md5 is None:
+        files = []
+        # scandir caches what it can of each entry's stat
+        with os.scandir(fp) as it:
+            for e in it:
+                if not e.is_file():
+                    log("Skipping {}: is a folder".format(e.path), level=4)
+                    continue
+                try: files.append((e.path, e.stat().st_size))
+                except OSError: # vanished or unreadable since the listing
+                    log("Couldn't stat {:s}, skipping it".format(e.path),
+                        level=1)
+        rows = [] # flushed to the database every BATCH_SIZE rows
+        for p, result in self.hash_files(files):
+            if result is None or result[2] is None:
                 log("Got no hash for {:s}, probably not a valid file"\
-                    .format(fn), level=4)
+                    .format(os.path.basename(p)), level=4)
                 continue
-            log("rfn={:s} size={:d} md5={:s}".format(rfn, size, md5), level=4)
-            self.db.put(rfn, size, md5)
+            rfn, size, md5 = result
+            if MIN_LEVEL >= 4: # don't hex the digest just to throw it away
+                log("rfn={:s} size={:d} md5={:s}"\
+                    .format(rfn, size, md5.hex()), level=4)
+            rows.append((rfn, size, md5))
+            if len(rows) >= BATCH_SIZE:
+                self.db.put_many(rows)
+                rows = []
+        self.db.put_many(rows)
         self.db.commit()
 
     def scan_game(self, fp):
@@ -303,8 +487,7 @@ class UserInterface(object):
         # validate validity of search md5 string, return before altering db
         if search_md5 is not None:
             search_md5 = search_md5.casefold()
-            if not all(map(lambda q: q in "abcdef1234567890", search_md5)) and \
-               len(search_md5) != 32:
+            if not (len(search_md5) == 32 and _HEX_SET.issuperset(search_md5)):
                 log("Search MD5 string invalid!", level=0)
                 self.exit_code = 1
                 return
@@ -414,16 +597,16 @@ lowercase.", level=-3)
             return
         target = getattr(self, "of", stdout)
         print("filename\tsize\tmd5", file=target)
-        row = self.h.check_one_file(fp, skip_weird=False)
-        print(*row, sep='\t', file=target)
+        rfn, size, md5 = self.h.check_one_file(fp, skip_weird=False)
+        if md5 is not None: md5 = md5.hex()
+        print(rfn, size, md5, sep='\t', file=target)
         print(end='', file=target, flush=True)
 
     def cmd_find(self, arg):
         """Search the database for a MD5 hash"""
         self.sm5 = arg.lower()
         # borrow some code
-        if not all(map(lambda q: q in "abcdef1234567890", self.sm5)) and \
-           len(self.sm5) != 32:
+        if not (len(self.sm5) == 32 and _HEX_SET.issuperset(self.sm5)):
             log("Search MD5 string invalid!", level=-2)
             return
         target = getattr(self, "of", stdout)